@@ -22,9 +22,8 @@ log.level = logging.DEBUG
 
 coloredlogs.install(level="DEBUG", logger=log)
 
-# Load config
-with open("./config.yaml") as f:
-    config = yaml.safe_load(f)["geotiff_from_lidar"]
+# Loaded in __main__, so the rasterizing functions can be imported without a config file
+config = None
 
 # Define the CRS for the input point cloud (CRS 3059)
 CRS = CRS.from_epsg(3059)
@@ -208,6 +207,13 @@ def check_can_continue_processing(input_path, tiff_path, tiff_filename, url):
     
     return True
 
+def map_classification_colors(classification, color_map):
+    # Map classifications to opaque RGBA colors using a lookup table, unmapped classes are white
+    color_lut = np.full((256, 4), 255, dtype=np.uint8)
+    for point_class, color in color_map.items():
+        color_lut[point_class, :3] = color
+    return color_lut[classification]
+
 def generate_color_raster(input_path, tiff_filename, options, url):
     output_tiff_path = os.path.join(options["path"], tiff_filename)
     
@@ -241,15 +247,14 @@ def generate_color_raster(input_path, tiff_filename, options, url):
     img = np.zeros((img_height, img_width, 4), dtype=np.uint8)
 
     # Map classifications to colors
-    colors = np.array([options["color_map"].get(c, (255, 255, 255)) for c in classification])
+    colors = map_classification_colors(classification, options["color_map"])
 
     # Calculate the pixel coordinates for each point
     px = x - min_x
     py = max_y - y
 
-    # Assign colors to the corresponding pixels
-    img[py, px, :3] = colors  # RGB channels
-    img[py, px, 3] = 255  # Opaque background
+    # Assign colors to the corresponding pixels, the alpha channel makes them opaque
+    img[py, px] = colors
 
     # Create a GeoTIFF with proper scaling
     transform = from_origin(min_x, max_y, 1, 1)  # Adjust resolution if needed
@@ -360,6 +365,10 @@ def generate_linear_raster(input_path, tiff_filename, options, url):
     log.info(f"Generated linear GeoTIFF {output_tiff_path}")
     
 if __name__ == "__main__":
+    # Load config
+    with open("./config.yaml") as f:
+        config = yaml.safe_load(f)["geotiff_from_lidar"]
+
     main()
     
     # Start processes
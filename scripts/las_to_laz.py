@@ -1,64 +1,290 @@
-import laspy
-from flask import Flask, request, send_file
+import os
+import glob
+import time
+import hashlib
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, request
 import requests
-from io import BytesIO
-import requests_cache
+import yaml
+import logging
+import coloredlogs
 
-app = Flask(__name__)
+log = logging.getLogger(__name__)
+log.level = logging.DEBUG
 
-requests_cache.install_cache('las_cache', expire_after=120)
+coloredlogs.install(level="DEBUG", logger=log)
 
-# Route for processing and forwarding the file
-@app.route('/convert-to-laz', methods=['GET'])
-def compress_las_to_laz_http():
-    try:
+chunk_size = 1024 * 1024  # 1MB chunk size
+# requests waits until a whole chunk has arrived, so upstream data is passed on in smaller pieces
+upload_chunk_size = 64 * 1024  # 64KB chunk size
+
+# .part files that have not been written to for this long are left over from a crashed process
+stale_part_age = 60 * 60
+
+class ConversionJob:
+    def __init__(self, service, url, cache_key):
+        self.service = service
+        self.url = url
+        self.cache_key = cache_key
+        # A unique file, so several service processes converting the same URL don't write into the same file.
+        # Created now, so clients can open it before any data has been written.
+        part_fd, self.part_path = tempfile.mkstemp(dir=service.config["cache_path"], suffix=".laz.part")
+        self.part_file = os.fdopen(part_fd, "wb")
+        self.bytes_written = 0
+        self.done = False
+        self.error = None
+        self.condition = threading.Condition()
+
+    def run(self):
+        error = None
+        try:
+            self.convert()
+            with self.service.jobs_lock:
+                os.replace(self.part_path, self.service.get_cache_path(self.cache_key))
+                del self.service.jobs[self.cache_key]
+        except Exception as e:
+            log.error(f"Could not convert {self.url}", exc_info=True)
+            error = e
+            self.part_file.close()
+            with self.service.jobs_lock:
+                # Leave jobs first, so later requests start a new conversion even if the cleanup fails
+                self.service.jobs.pop(self.cache_key, None)
+                try:
+                    os.remove(self.part_path)
+                except OSError:
+                    log.warning(f"Could not remove {self.part_path}", exc_info=True)
+        else:
+            log.info(f"Cached {self.url} as {self.cache_key}.laz")
+            try:
+                self.service.evict_cache(keep=self.cache_key)
+            except Exception:
+                # The file has been cached, so the conversion itself still succeeded
+                log.error("Could not evict files from the cache", exc_info=True)
+        finally:
+            with self.condition:
+                self.error = error
+                self.done = True
+                self.condition.notify_all()
+
+    def convert(self):
+        log.info(f"Converting {self.url}")
+
+        config = self.service.config
+        timeout = (config["upstream_connect_timeout"], config["upstream_read_timeout"])
+        with requests.get(self.url, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+
+            # laszip writes its messages to a file, so it can't block on a full stderr pipe
+            with tempfile.TemporaryFile() as laszip_errors:
+                # laszip compresses the LAS as it arrives on stdin and writes the LAZ to stdout
+                laszip = subprocess.Popen(
+                    [config["laszip_path"], "-stdin", "-stdout", "-olaz"],
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    stderr=laszip_errors,
+                )
+
+                upload_errors = []
+                upload_thread = threading.Thread(target=self.upload, args=(response, laszip, upload_errors))
+                upload_thread.start()
+
+                try:
+                    while chunk := laszip.stdout.read1(chunk_size):
+                        self.part_file.write(chunk)
+                        self.part_file.flush()
+                        with self.condition:
+                            self.bytes_written += len(chunk)
+                            self.condition.notify_all()
+                except:
+                    # Stop laszip so the upload thread does not block on a full pipe
+                    laszip.kill()
+                    raise
+                finally:
+                    upload_thread.join()
+                    laszip.stdout.close()
+                    returncode = laszip.wait()
+                    self.part_file.close()
+
+                # laszip gets killed when the upstream fails, so its exit code only matters otherwise
+                if upload_errors:
+                    raise upload_errors[0]
+                if returncode != 0:
+                    laszip_errors.seek(0)
+                    message = laszip_errors.read().decode(errors="replace").strip()
+                    raise RuntimeError(f"laszip exited with code {returncode}: {message}")
+
+    def upload(self, response, laszip, upload_errors):
+        try:
+            for chunk in response.iter_content(chunk_size=upload_chunk_size):
+                laszip.stdin.write(chunk)
+        except BrokenPipeError:
+            # laszip stopped reading, its exit code and messages tell why
+            pass
+        except Exception as e:
+            upload_errors.append(e)
+            # Stop laszip so the reading side does not wait forever
+            laszip.kill()
+        finally:
+            response.close()
+            try:
+                laszip.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def wait_for_data(self, offset):
+        # Returns True if there is data past the offset, False once the job is finished
+        client_timeout = self.service.config["client_timeout"]
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.bytes_written > offset or self.done, client_timeout):
+                raise TimeoutError(f"No data from conversion of {self.url} in {client_timeout} seconds")
+            return self.bytes_written > offset
+
+class ConversionService:
+    def __init__(self, config):
+        self.config = config
+        # Conversions run in a pool, requests for a URL that is already being converted attach to the running job
+        self.conversion_pool = ThreadPoolExecutor(max_workers=config["conversion_threads"])
+        self.jobs = {}
+        self.jobs_lock = threading.Lock()
+        self.eviction_lock = threading.Lock()
+
+    def get_cache_path(self, cache_key):
+        return os.path.join(self.config["cache_path"], cache_key + ".laz")
+
+    def evict_cache(self, keep):
+        # Remove least recently used files until the cache fits in the size limit.
+        # Only one thread evicts at a time, otherwise they would all remove files for the same excess.
+        with self.eviction_lock:
+            max_size = self.config["cache_max_size_mb"] * 1024 * 1024
+            cached_files = []
+            for path in glob.glob(os.path.join(self.config["cache_path"], "*.laz")):
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                cached_files.append((stat.st_mtime, stat.st_size, path))
+
+            cache_size = sum(size for _, size, _ in cached_files)
+            for _, size, path in sorted(cached_files):
+                if cache_size <= max_size:
+                    break
+                if path == self.get_cache_path(keep):
+                    continue
+                log.debug(f"Evicting {path} from cache")
+                try:
+                    # Clients still streaming the file keep their open handle
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                cache_size -= size
+
+def get_cache_key(url):
+    # Tiles never change upstream, so the URL identifies the content
+    return hashlib.sha256(url.encode()).hexdigest()
+
+def is_allowed_url(url, prefix):
+    # Don't let ".." segments climb out of the allowed prefix
+    return url.startswith(prefix) and ".." not in url[len(prefix):].split("/")
+
+def remove_stale_parts(cache_path):
+    # Other service processes may still be writing their .part files, so only remove old ones
+    for part_path in glob.glob(os.path.join(cache_path, "*.laz.part")):
+        try:
+            if time.time() - os.path.getmtime(part_path) > stale_part_age:
+                os.remove(part_path)
+        except FileNotFoundError:
+            pass
+
+def stream_file(file):
+    with file:
+        while chunk := file.read(chunk_size):
+            yield chunk
+
+def stream_job(job, file):
+    with file:
+        offset = 0
+        while job.wait_for_data(offset):
+            chunk = file.read(chunk_size)
+            offset += len(chunk)
+            yield chunk
+        if job.error is not None:
+            # Headers have already been sent, so the only way to signal failure is to cut the stream
+            raise RuntimeError(f"Conversion of {job.url} failed")
+        # Send whatever was written between the last read and the job finishing
+        while chunk := file.read(chunk_size):
+            yield chunk
+
+def laz_response(body, size=None):
+    headers = {"Content-Disposition": "inline; filename=compressed.laz"}
+    # The size is only known for cached files, conversions in progress use chunked transfer encoding
+    if size is not None:
+        headers["Content-Length"] = str(size)
+    return Response(body, mimetype='application/octet-stream', headers=headers)
+
+def create_app(config):
+    os.makedirs(config["cache_path"], exist_ok=True)
+
+    service = ConversionService(config)
+    app = Flask(__name__)
+
+    # Route for processing and forwarding the file
+    @app.route('/convert-to-laz', methods=['GET'])
+    def compress_las_to_laz_http():
         url = request.args.get('url')
 
         if not url:
             return "Missing 'url' in the request.", 400
 
-        print(f"Downloading file: {url}")
-        
-        chunk_size = 1024 * 1024 * 10  # 10MB chunk size
-        save_path = "temp/" + url.split("/las/")[1].replace("/", "-")
-        
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
-        
-        with open(save_path, 'wb') as file:
-            for chunk in response.iter_content(chunk_size=chunk_size):
-                if chunk:
-                    print(".")
-                    file.write(chunk)
-        
-        print(f"Converting file: {url}")
-
-        # Read the input LAS file
-        las = laspy.read(save_path)
-
-        # Create a new LasData object for the output file with compression enabled
-        output_las = laspy.LasData(las.header)
-
-        # Copy all points from the input LasData object to the output LasData object
-        output_las.points = las.points.copy()
-
-        compressed_file = BytesIO()
-        
-        # Set a filename
-        compressed_file.filename = "compressed.laz"
-        
-        # Write the compressed LAZ file
-        output_las.write(compressed_file, do_compress=True)
-
-        return send_file(
-            compressed_file,
-            as_attachment=False,
-            download_name='compressed.laz',
-            mimetype='application/octet-stream'
-        )
-    except Exception as e:
-        print(e)
-        return str(e), 500
+        if not is_allowed_url(url, config["allowed_url_prefix"]):
+            return "The 'url' is not from the allowed upstream.", 403
+
+        cache_key = get_cache_key(url)
+        cache_path = service.get_cache_path(cache_key)
+
+        # The lock makes sure a finished job is either still in jobs or already in the cache
+        with service.jobs_lock:
+            job = service.jobs.get(cache_key)
+            if job is None:
+                try:
+                    file = open(cache_path, "rb")
+                except FileNotFoundError:
+                    job = ConversionJob(service, url, cache_key)
+                    service.jobs[cache_key] = job
+                    service.conversion_pool.submit(job.run)
+                else:
+                    # Mark as recently used for eviction. Uses the open file, which eviction can't take away.
+                    os.utime(file.fileno())
+                    log.debug(f"Serving {url} from cache")
+                    return laz_response(stream_file(file), os.fstat(file.fileno()).st_size)
+            file = open(job.part_path, "rb")
+
+        # Report upstream and conversion errors properly if nothing has been sent yet
+        try:
+            has_data = job.wait_for_data(0)
+        except TimeoutError as e:
+            file.close()
+            return str(e), 504
+        if not has_data and job.error is not None:
+            file.close()
+            return str(job.error), 502
+
+        return laz_response(stream_job(job, file))
+
+    return app
+
+def main():
+    # Load config
+    with open("./config.yaml") as f:
+        config = yaml.safe_load(f)["las_to_laz"]
+
+    os.makedirs(config["cache_path"], exist_ok=True)
+    remove_stale_parts(config["cache_path"])
+
+    app = create_app(config)
+    app.run(host='0.0.0.0', port=config["port"], threaded=True)
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8080)
+    main()
@@ -0,0 +1,28 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import geotiff_from_lidar
+
+color_map = {
+    1: [170, 170, 170],
+    2: [170, 85, 0],
+    6: [255, 85, 85],
+}
+
+def test_map_classification_colors_matches_per_point_lookup():
+    rng = np.random.default_rng(0)
+    classification = rng.integers(0, 20, 10000)
+    py = rng.integers(0, 50, len(classification))
+    px = rng.integers(0, 50, len(classification))
+
+    # How the color raster was filled before the lookup table, duplicate pixels keep the last point
+    expected = np.zeros((50, 50, 4), dtype=np.uint8)
+    expected[py, px, :3] = np.array([color_map.get(c, (255, 255, 255)) for c in classification])
+    expected[py, px, 3] = 255
+
+    img = np.zeros((50, 50, 4), dtype=np.uint8)
+    img[py, px] = geotiff_from_lidar.map_classification_colors(classification, color_map)
+
+    np.testing.assert_array_equal(img, expected)
@@ -0,0 +1,288 @@
+import io
+import os
+import sys
+import stat
+import time
+import struct
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+import las_to_laz
+
+repo_laszip = os.path.join(os.path.dirname(__file__), "..", "laszip")
+
+# Stands in for laszip: rejects anything that is not a LAS file and otherwise passes the input through
+fake_laszip = f"""#!{sys.executable}
+import sys
+signature = sys.stdin.buffer.read(4)
+if signature != b"LASF":
+    sys.stderr.write("ERROR: input is not a LAS file\\n")
+    sys.exit(1)
+sys.stdout.buffer.write(signature)
+sys.stdout.buffer.flush()
+while chunk := sys.stdin.buffer.read1(65536):
+    sys.stdout.buffer.write(chunk)
+    sys.stdout.buffer.flush()
+"""
+
+def make_las(point_count):
+    # LAS 1.2 with point format 0 and no VLRs
+    points = b"".join(struct.pack("<3iHBBbBH", i, i, i, 0, 0, 2, 0, 0, 0) for i in range(point_count))
+    header = struct.pack(
+        "<4sHH16sBB32s32sHHHIIBHI5I3d3d6d",
+        b"LASF", 0, 0, bytes(16), 1, 2, b"test".ljust(32, b"\0"), b"test".ljust(32, b"\0"),
+        1, 2024, 227, 227, 0, 0, 20, point_count, point_count, 0, 0, 0, 0,
+        0.01, 0.01, 0.01, 0, 0, 0,
+        (point_count - 1) * 0.01, 0, (point_count - 1) * 0.01, 0, (point_count - 1) * 0.01, 0,
+    )
+    assert len(header) == 227
+    return header + points
+
+class Upstream:
+    def __init__(self):
+        # Path -> (status, body, event to wait for before sending the second half of the body)
+        self.files = {}
+        self.hits = {}
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                upstream.hits[self.path] = upstream.hits.get(self.path, 0) + 1
+                status, body, gate = upstream.files.get(self.path, (404, b"Not found", None))
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body[:len(body) // 2])
+                self.wfile.flush()
+                if gate is not None:
+                    gate.wait(10)
+                self.wfile.write(body[len(body) // 2:])
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/las/"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+@pytest.fixture
+def upstream():
+    upstream = Upstream()
+    yield upstream
+    upstream.server.shutdown()
+
+def make_config(tmp_path, upstream, laszip_path=None, **overrides):
+    if laszip_path is None:
+        laszip_path = tmp_path / "laszip"
+        laszip_path.write_text(fake_laszip)
+        laszip_path.chmod(laszip_path.stat().st_mode | stat.S_IEXEC)
+    config = {
+        "port": 0,
+        "conversion_threads": 2,
+        "cache_path": str(tmp_path / "cache"),
+        "cache_max_size_mb": 10,
+        "allowed_url_prefix": upstream.url,
+        "upstream_connect_timeout": 5,
+        "upstream_read_timeout": 5,
+        "client_timeout": 10,
+        "laszip_path": str(laszip_path),
+    }
+    config.update(overrides)
+    return config
+
+def cached_files(config):
+    return sorted(name for name in os.listdir(config["cache_path"]))
+
+def test_converts_then_serves_from_cache(tmp_path, upstream):
+    las = make_las(10)
+    upstream.files["/las/a.las"] = (200, las, None)
+    config = make_config(tmp_path, upstream)
+    client = las_to_laz.create_app(config).test_client()
+
+    response = client.get("/convert-to-laz", query_string={"url": upstream.url + "a.las"})
+    assert response.status_code == 200
+    assert response.data == las
+    assert cached_files(config) == [las_to_laz.get_cache_key(upstream.url + "a.las") + ".laz"]
+
+    response = client.get("/convert-to-laz", query_string={"url": upstream.url + "a.las"})
+    assert response.status_code == 200
+    assert response.data == las
+    assert response.headers["Content-Length"] == str(len(las))
+    assert upstream.hits["/las/a.las"] == 1
+
+def test_streams_while_converting_and_shares_the_conversion(tmp_path, upstream):
+    # Big enough for the first half to fill a few upload chunks
+    las = make_las(20000)
+    gate = threading.Event()
+    upstream.files["/las/a.las"] = (200, las, gate)
+    client = las_to_laz.create_app(make_config(tmp_path, upstream)).test_client()
+    url = upstream.url + "a.las"
+
+    first = client.get("/convert-to-laz", query_string={"url": url}, buffered=False)
+    second = client.get("/convert-to-laz", query_string={"url": url}, buffered=False)
+    # Only the first half of the upstream body has been sent, but data is already streaming
+    assert "Content-Length" not in first.headers
+    first_chunks = iter(first.response)
+    first_data = next(first_chunks)
+    assert 0 < len(first_data) < len(las)
+
+    gate.set()
+    assert first_data + b"".join(first_chunks) == las
+    assert b"".join(second.response) == las
+    assert upstream.hits["/las/a.las"] == 1
+
+def test_evicts_least_recently_used(tmp_path, upstream):
+    las = make_las(10)
+    for name in ("a.las", "b.las", "c.las"):
+        upstream.files["/las/" + name] = (200, las, None)
+    # Room for two files
+    config = make_config(tmp_path, upstream, cache_max_size_mb=2.5 * len(las) / 1024 / 1024)
+    client = las_to_laz.create_app(config).test_client()
+
+    # Using a again makes b the least recently used
+    for name in ("a.las", "b.las", "a.las", "c.las"):
+        response = client.get("/convert-to-laz", query_string={"url": upstream.url + name})
+        # Reading the whole response waits for the conversion to finish
+        assert response.data == las
+        # Make sure the modification times differ
+        time.sleep(0.05)
+
+    expected = [las_to_laz.get_cache_key(upstream.url + name) + ".laz" for name in ("a.las", "c.las")]
+    assert cached_files(config) == sorted(expected)
+
+def test_reports_laszip_errors(tmp_path, upstream):
+    upstream.files["/las/a.las"] = (200, b"<html>Not a LAS file</html>" * 1000, None)
+    config = make_config(tmp_path, upstream)
+    client = las_to_laz.create_app(config).test_client()
+
+    response = client.get("/convert-to-laz", query_string={"url": upstream.url + "a.las"})
+    assert response.status_code == 502
+    assert b"input is not a LAS file" in response.data
+    assert cached_files(config) == []
+
+def test_reports_upstream_errors(tmp_path, upstream):
+    config = make_config(tmp_path, upstream)
+    client = las_to_laz.create_app(config).test_client()
+
+    response = client.get("/convert-to-laz", query_string={"url": upstream.url + "missing.las"})
+    assert response.status_code == 502
+    assert b"404" in response.data
+    assert cached_files(config) == []
+
+def test_reports_stalled_upstream(tmp_path, upstream):
+    gate = threading.Event()
+    upstream.files["/las/a.las"] = (200, make_las(20000), gate)
+    config = make_config(tmp_path, upstream, upstream_read_timeout=0.5)
+    client = las_to_laz.create_app(config).test_client()
+
+    response = client.get("/convert-to-laz", query_string={"url": upstream.url + "a.las"}, buffered=False)
+    # The first half of the file got through before the upstream stalled, so the stream gets cut
+    with pytest.raises(RuntimeError):
+        b"".join(response.response)
+    gate.set()
+    assert cached_files(config) == []
+
+def test_recovers_when_caching_fails(tmp_path, upstream, monkeypatch):
+    las = make_las(10)
+    upstream.files["/las/a.las"] = (200, las, None)
+    config = make_config(tmp_path, upstream, client_timeout=2)
+    client = las_to_laz.create_app(config).test_client()
+    url = upstream.url + "a.las"
+
+    def fail_replace(src, dst):
+        raise PermissionError(dst)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(las_to_laz.os, "replace", fail_replace)
+        response = client.get("/convert-to-laz", query_string={"url": url}, buffered=False)
+        # Either the job failed before the response started, or the stream gets cut
+        if response.status_code == 200:
+            with pytest.raises(RuntimeError):
+                b"".join(response.response)
+        else:
+            assert response.status_code == 502
+    assert cached_files(config) == []
+
+    # The failed job is gone, so the next request converts again instead of waiting for it
+    response = client.get("/convert-to-laz", query_string={"url": url})
+    assert response.status_code == 200
+    assert response.data == las
+    assert upstream.hits["/las/a.las"] == 2
+
+def test_serves_conversion_when_eviction_fails(tmp_path, upstream, monkeypatch):
+    las = make_las(10)
+    for name in ("a.las", "b.las"):
+        upstream.files["/las/" + name] = (200, las, None)
+    # Room for one file, so the second conversion has to evict
+    config = make_config(tmp_path, upstream, client_timeout=2, cache_max_size_mb=1.5 * len(las) / 1024 / 1024)
+    client = las_to_laz.create_app(config).test_client()
+    assert client.get("/convert-to-laz", query_string={"url": upstream.url + "a.las"}).data == las
+
+    def fail_remove(path):
+        raise PermissionError(path)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(las_to_laz.os, "remove", fail_remove)
+        response = client.get("/convert-to-laz", query_string={"url": upstream.url + "b.las"})
+        assert response.status_code == 200
+        assert response.data == las
+
+    # Served from the cache
+    assert client.get("/convert-to-laz", query_string={"url": upstream.url + "b.las"}).data == las
+    assert upstream.hits["/las/b.las"] == 1
+
+def test_rejects_urls_outside_the_allowed_prefix(tmp_path, upstream):
+    client = las_to_laz.create_app(make_config(tmp_path, upstream)).test_client()
+
+    for url in ("http://example.com/las/a.las", upstream.url + "../secret"):
+        response = client.get("/convert-to-laz", query_string={"url": url})
+        assert response.status_code == 403
+    assert client.get("/convert-to-laz").status_code == 400
+    assert upstream.hits == {}
+
+def laszip_runs():
+    try:
+        return subprocess.run([repo_laszip, "-version"], capture_output=True).returncode == 0
+    except OSError:
+        return False
+
+def make_laspy_las(version, point_format):
+    laspy = pytest.importorskip("laspy")
+    header = laspy.LasHeader(version=version, point_format=point_format)
+    header.scales = [0.01, 0.01, 0.01]
+    las = laspy.LasData(header)
+    rng = np.random.default_rng(0)
+    las.x = rng.uniform(500000, 501000, 100000)
+    las.y = rng.uniform(300000, 301000, 100000)
+    las.z = rng.uniform(0, 300, 100000)
+    las.classification = rng.integers(1, 10, 100000)
+    if version == "1.4":
+        from laspy.vlrs.vlrlist import VLRList
+        las.evlrs = VLRList([laspy.VLR(user_id="test", record_id=1, description="evlr", record_data=b"extended vlr")])
+    file = io.BytesIO()
+    las.write(file)
+    # Read it back, so the header has the counts and bounds filled in by writing
+    return laspy.read(io.BytesIO(file.getvalue())), file.getvalue()
+
+@pytest.mark.skipif(not laszip_runs(), reason="laszip binary can't run here")
+@pytest.mark.parametrize("version, point_format", [("1.2", 1), ("1.4", 6)])
+def test_compresses_with_laszip(tmp_path, upstream, version, point_format):
+    laspy = pytest.importorskip("laspy")
+    las, las_data = make_laspy_las(version, point_format)
+    upstream.files["/las/a.las"] = (200, las_data, None)
+    config = make_config(tmp_path, upstream, laszip_path=repo_laszip)
+    client = las_to_laz.create_app(config).test_client()
+
+    response = client.get("/convert-to-laz", query_string={"url": upstream.url + "a.las"})
+    assert response.status_code == 200
+    assert len(response.data) < len(las_data)
+
+    laz = laspy.read(io.BytesIO(response.data))
+    assert laz.header.are_points_compressed
+    assert laz.header.point_count == las.header.point_count
+    np.testing.assert_array_equal(laz.points.array, las.points.array)
+    assert [evlr.record_data for evlr in laz.evlrs or []] == [evlr.record_data for evlr in las.evlrs or []]